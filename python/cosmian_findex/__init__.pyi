@@ -1,4 +1,5 @@
-from typing import Callable, Optional, Dict, List
+from concurrent.futures import Executor
+from typing import Callable, Optional, Dict, List, Mapping, Sequence, Tuple, Union
 
 class IndexedValue:
     """The value indexed by a `Keyword`. It can be either a `Location` or another
@@ -104,6 +105,33 @@ class MasterKey:
             MasterKey
         """
 
+class StopOnKeyword:
+    """Progress predicate stopping a search once the given keyword is reached
+    by the recursion. It is evaluated by Findex without calling Python.
+    """
+
+    def __init__(self, keyword: Union[str, bytes]) -> None:
+        """Create a predicate stopping the search on the given keyword.
+
+        Args:
+            keyword (Union[str, bytes])
+        """
+
+class MaxResults:
+    """Progress predicate stopping a search once at least the given number of
+    locations have been found, counting all the recursion levels explored so
+    far. Since all the locations of the last explored level are returned, the
+    search may return more locations than this number. It is evaluated by
+    Findex without calling Python.
+    """
+
+    def __init__(self, max_results: int) -> None:
+        """Create a predicate stopping the search after `max_results` locations.
+
+        Args:
+            max_results (int)
+        """
+
 class InternalFindex:
     """This is an internal class. See `cloudproof_py.findex.Findex` abstract class instead."""
 
@@ -118,7 +146,7 @@ class InternalFindex:
         self,
         fetch_entry_table: Callable,
         fetch_chain_table: Callable,
-        progress_callback: Callable,
+        progress_callback: Union[Callable, StopOnKeyword, MaxResults],
     ) -> None: ...
     def set_compact_callbacks(
         self,
@@ -127,10 +155,18 @@ class InternalFindex:
         update_lines: Callable,
         list_removed_locations: Callable,
         fetch_all_entry_table_uids: Callable,
+        executor: Optional[Executor] = None,
+        batch_size: int = 1000,
     ) -> None: ...
     def upsert_wrapper(
         self,
-        indexed_values_and_keywords: Dict[IndexedValue, List[str]],
+        indexed_values_and_keywords: Mapping[IndexedValue, Sequence[Union[str, bytes]]],
+        master_key: MasterKey,
+        label: Label,
+    ) -> None: ...
+    def upsert_wrapper_locations(
+        self,
+        locations_and_keywords: Mapping[bytes, Sequence[Union[str, bytes]]],
         master_key: MasterKey,
         label: Label,
     ) -> None: ...
@@ -142,6 +178,14 @@ class InternalFindex:
         max_result_per_keyword: int = 2**32 - 1,
         max_depth: int = 100,
     ) -> Dict[str, List[IndexedValue]]: ...
+    def search_wrapper_bulk(
+        self,
+        keywords: List[str],
+        msk: MasterKey,
+        label: Label,
+        max_result_per_keyword: int = 2**32 - 1,
+        max_depth: int = 100,
+    ) -> Dict[str, Tuple[bytes, bytes]]: ...
     def compact_wrapper(
         self,
         num_reindexing_before_full_set: int,
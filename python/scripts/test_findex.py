@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
 import unittest
-from cosmian_findex import IndexedValue, Label, MasterKey, InternalFindex
-from typing import Dict, List, Set, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cosmian_findex import (
+    IndexedValue,
+    Label,
+    MasterKey,
+    InternalFindex,
+    MaxResults,
+    StopOnKeyword,
+)
+from typing import Any, Callable, Dict, FrozenSet, List, Set, Tuple
 
 
 class TestStructures(unittest.TestCase):
@@ -57,18 +68,31 @@ class TestStructures(unittest.TestCase):
 class FindexHashmap:
     """Implement Findex callbacks using hashmaps"""
 
+    # Maximum number of `fetch_entry` results kept in cache
+    FETCH_ENTRY_CACHE_SIZE = 128
+
     def __init__(self, db):
         self.db = db
         self.entry_table: Dict[bytes, bytes] = {}
         self.chain_table: Dict[bytes, bytes] = {}
+        # LRU cache of `fetch_entry` results, cleared when the Entry Table changes
+        self.fetch_entry_cache: 'OrderedDict[FrozenSet[bytes], Dict[bytes, bytes]]' = (
+            OrderedDict()
+        )
 
     # Create callback functions
     def fetch_entry(self, uids: List[bytes]) -> Dict[bytes, bytes]:
         """DB request to fetch entry_table elements"""
-        res = {}
-        for uid in uids:
-            if uid in self.entry_table:
-                res[uid] = self.entry_table[uid]
+        key = frozenset(uids)
+        res = self.fetch_entry_cache.get(key)
+        if res is not None:
+            self.fetch_entry_cache.move_to_end(key)
+            return res
+
+        res = {uid: self.entry_table[uid] for uid in uids if uid in self.entry_table}
+        self.fetch_entry_cache[key] = res
+        if len(self.fetch_entry_cache) > self.FETCH_ENTRY_CACHE_SIZE:
+            self.fetch_entry_cache.popitem(last=False)
         return res
 
     def fetch_all_entry_table_uids(self) -> Set[bytes]:
@@ -76,11 +100,7 @@ class FindexHashmap:
 
     def fetch_chain(self, uids: List[bytes]) -> Dict[bytes, bytes]:
         """DB request to fetch chain_table elements"""
-        res = {}
-        for uid in uids:
-            if uid in self.chain_table:
-                res[uid] = self.chain_table[uid]
-        return res
+        return {uid: self.chain_table[uid] for uid in uids if uid in self.chain_table}
 
     def upsert_entry(
         self, entries: Dict[bytes, Tuple[bytes, bytes]]
@@ -88,43 +108,42 @@ class FindexHashmap:
         """DB request to upsert entry_table elements.
         WARNING: This implementation will not work with concurrency.
         """
+        self.fetch_entry_cache.clear()
         rejected_lines = {}
         for uid, (old_val, new_val) in entries.items():
-            if uid in self.entry_table:
-                if self.entry_table[uid] == old_val:
-                    self.entry_table[uid] = new_val
-                else:
-                    rejected_lines[uid] = self.entry_table[uid]
-            elif not old_val:
+            # Entry Table values are bytes: `None` means the line does not exist
+            current_val = self.entry_table.get(uid)
+            if current_val is None:
+                if old_val:
+                    raise Exception('Line got deleted in Entry Table')
+                self.entry_table[uid] = new_val
+            elif current_val == old_val:
                 self.entry_table[uid] = new_val
             else:
-                raise Exception('Line got deleted in Entry Table')
+                rejected_lines[uid] = current_val
 
         return rejected_lines
 
     def insert_entry(self, entries: Dict[bytes, bytes]) -> None:
         """DB request to insert entry_table elements"""
-        for uid in entries:
-            if uid in self.entry_table:
-                raise KeyError('Conflict in Entry Table for UID: {uid}')
-            self.entry_table[uid] = entries[uid]
+        self.fetch_entry_cache.clear()
+        overlap = entries.keys() & self.entry_table.keys()
+        if overlap:
+            raise KeyError(f'Conflict in Entry Table for UIDs: {overlap!r}')
+        self.entry_table.update(entries)
 
     def insert_chain(self, entries: Dict[bytes, bytes]) -> None:
         """DB request to insert chain_table elements"""
-        for uid in entries:
-            if uid in self.chain_table:
-                raise KeyError('Conflict in Chain Table for UID: {uid}')
-            self.chain_table[uid] = entries[uid]
+        overlap = entries.keys() & self.chain_table.keys()
+        if overlap:
+            raise KeyError(f'Conflict in Chain Table for UIDs: {overlap!r}')
+        self.chain_table.update(entries)
 
     def progress_callback(self, _):
         return True
 
     def list_removed_locations(self, uids: List[bytes]) -> List[bytes]:
-        res = []
-        for uid in uids:
-            if not uid in self.db:
-                res.append(uid)
-        return res
+        return [uid for uid in uids if uid not in self.db]
 
     def update_lines(
         self,
@@ -134,10 +153,15 @@ class FindexHashmap:
     ) -> None:
         # remove all entries from entry table
         self.entry_table.clear()
+        self.fetch_entry_cache.clear()
 
         # remove entries from chain table
-        for uid in removed_chain_table_uids:
-            del self.chain_table[uid]
+        removed_uids = set(removed_chain_table_uids)
+        self.chain_table = {
+            uid: value
+            for uid, value in self.chain_table.items()
+            if uid not in removed_uids
+        }
 
         # insert new chains
         self.insert_chain(new_encrypted_chain_table_items)
@@ -146,30 +170,68 @@ class FindexHashmap:
         self.insert_entry(new_encrypted_entry_table_items)
 
 
+class TestFindexHashmap(unittest.TestCase):
+    def test_fetch_entry_cache(self) -> None:
+        backend = FindexHashmap({})
+        uids = [b'uid1', b'uid2']
+
+        backend.insert_entry({b'uid1': b'value1'})
+        self.assertEqual(backend.fetch_entry(uids), {b'uid1': b'value1'})
+
+        # `insert_entry` clears the cache
+        backend.insert_entry({b'uid2': b'value2'})
+        self.assertEqual(
+            backend.fetch_entry(uids), {b'uid1': b'value1', b'uid2': b'value2'}
+        )
+
+        # `upsert_entry` clears the cache
+        backend.upsert_entry({b'uid1': (b'value1', b'new_value1')})
+        self.assertEqual(
+            backend.fetch_entry(uids), {b'uid1': b'new_value1', b'uid2': b'value2'}
+        )
+
+        # `update_lines` clears the cache
+        backend.update_lines([], {b'uid2': b'new_value2'}, {})
+        self.assertEqual(backend.fetch_entry(uids), {b'uid2': b'new_value2'})
+
+
 class TestFindex(unittest.TestCase):
-    def setUp(self) -> None:
-        # Create structures needed by Findex
-        self.msk = MasterKey.random()
-        self.label = Label.random()
+    msk: MasterKey
+    label: Label
+    db_content: Dict[bytes, Tuple[bytes, ...]]
+    indexed_values_and_keywords: Dict[IndexedValue, Tuple[bytes, ...]]
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Keys can be shared since each test uses its own tables
+        cls.msk = MasterKey.random()
+        cls.label = Label.random()
+
+        # Keywords are given as bytes to avoid encoding them at each upsert
+        cls.db_content = {
+            b'1': (b'Martin', b'Sheperd'),
+            b'2': (b'Martial', b'Wilkins'),
+            b'3': (b'John', b'Sheperd'),
+        }
 
-        self.db = {
-            b'1': ['Martin', 'Sheperd'],
-            b'2': ['Martial', 'Wilkins'],
-            b'3': ['John', 'Sheperd'],
+        # Only build the `IndexedValue`s once since this goes through the Rust interface
+        cls.indexed_values_and_keywords = {
+            IndexedValue.from_location(k): v for k, v in cls.db_content.items()
         }
 
+    def setUp(self) -> None:
+        # Create structures needed by Findex
+        # Copy the DB since some tests remove lines from it
+        self.db = dict(self.db_content)
+
         self.findex_backend = FindexHashmap(self.db)
         self.findex_interface = InternalFindex()
 
     def test_upsert_search(self) -> None:
-        indexed_values_and_keywords = {
-            IndexedValue.from_location(k): v for k, v in self.db.items()
-        }
-
         # Calling Upsert without setting the proper callbacks will raise an Exception
         with self.assertRaises(Exception):
             self.findex_interface.upsert_wrapper(
-                indexed_values_and_keywords, self.msk, self.label
+                self.indexed_values_and_keywords, self.msk, self.label
             )
 
         # Set upsert callbacks here
@@ -180,9 +242,7 @@ class TestFindex(unittest.TestCase):
             self.findex_backend.insert_chain,
         )
 
-        self.findex_interface.upsert_wrapper(
-            indexed_values_and_keywords, self.msk, self.label
-        )
+        self.findex_interface.upsert_wrapper_locations(self.db, self.msk, self.label)
         self.assertEqual(len(self.findex_backend.entry_table), 5)
         self.assertEqual(len(self.findex_backend.chain_table), 5)
 
@@ -204,6 +264,27 @@ class TestFindex(unittest.TestCase):
         self.assertEqual(len(res['Sheperd']), 2)
         self.assertEqual(len(res['Wilkins']), 1)
 
+        # Locations can also be fetched in a single buffer per keyword
+        res_bulk = self.findex_interface.search_wrapper_bulk(
+            ['Sheperd', 'Wilkins'], self.msk, self.label
+        )
+        offsets, payload = res_bulk['Sheperd']
+        # Locations are read through memory views to avoid copying them
+        offsets_view = memoryview(offsets).cast('I')
+        payload_view = memoryview(payload)
+        self.assertEqual(len(offsets_view), 3)
+        location_views = [
+            payload_view[offsets_view[i] : offsets_view[i + 1]]
+            for i in range(len(offsets_view) - 1)
+        ]
+        for location_view in location_views:
+            self.assertIs(location_view.obj, payload)
+        self.assertEqual({view.tobytes() for view in location_views}, {b'1', b'3'})
+
+        offsets, payload = res_bulk['Wilkins']
+        self.assertEqual(list(memoryview(offsets).cast('I')), [0, 1])
+        self.assertEqual(payload, b'2')
+
     def test_graph_upsert_search(self) -> None:
         self.findex_interface.set_upsert_callbacks(
             self.findex_backend.fetch_entry,
@@ -217,11 +298,8 @@ class TestFindex(unittest.TestCase):
             self.findex_backend.progress_callback,
         )
 
-        indexed_values_and_keywords = {
-            IndexedValue.from_location(k): v for k, v in self.db.items()
-        }
         self.findex_interface.upsert_wrapper(
-            indexed_values_and_keywords, self.msk, self.label
+            self.indexed_values_and_keywords, self.msk, self.label
         )
 
         # Adding custom keywords graph
@@ -241,7 +319,59 @@ class TestFindex(unittest.TestCase):
         # 2 names starting with Mar
         self.assertEqual(len(res['Mar']), 2)
 
-    def test_compact(self) -> None:
+        # Stop the recursion once 'Martin' is reached: 'Martial' is not found
+        for predicate in (
+            StopOnKeyword('Martin'),
+            StopOnKeyword(b'Martin'),
+            MaxResults(1),
+        ):
+            self.findex_interface.set_search_callbacks(
+                self.findex_backend.fetch_entry,
+                self.findex_backend.fetch_chain,
+                predicate,
+            )
+            res = self.findex_interface.search_wrapper(['Mar'], self.msk, self.label)
+            self.assertEqual(len(res['Mar']), 1)
+            self.assertEqual(res['Mar'][0].get_location(), b'1')
+
+    def test_max_results(self) -> None:
+        self.findex_interface.set_upsert_callbacks(
+            self.findex_backend.fetch_entry,
+            self.findex_backend.fetch_chain,
+            self.findex_backend.upsert_entry,
+            self.findex_backend.insert_chain,
+        )
+
+        # Each level of the graph indexes one location and the next level
+        graph = {
+            IndexedValue.from_location(b'1'): [b'level0'],
+            IndexedValue.from_keyword(b'level1'): [b'level0'],
+            IndexedValue.from_location(b'2'): [b'level1'],
+            IndexedValue.from_keyword(b'level2'): [b'level1'],
+            IndexedValue.from_location(b'3'): [b'level2'],
+            IndexedValue.from_keyword(b'level3'): [b'level2'],
+            IndexedValue.from_location(b'4'): [b'level3'],
+        }
+        self.findex_interface.upsert_wrapper(graph, self.msk, self.label)
+
+        # Locations are counted across recursion levels
+        for max_results, expected_locations in (
+            (1, {b'1'}),
+            (2, {b'1', b'2'}),
+            (3, {b'1', b'2', b'3'}),
+            (10, {b'1', b'2', b'3', b'4'}),
+        ):
+            self.findex_interface.set_search_callbacks(
+                self.findex_backend.fetch_entry,
+                self.findex_backend.fetch_chain,
+                MaxResults(max_results),
+            )
+            res = self.findex_interface.search_wrapper(['level0'], self.msk, self.label)
+            self.assertEqual(
+                {value.get_location() for value in res['level0']}, expected_locations
+            )
+
+    def compact_and_check(self, fetch_chain: Callable, **compact_options: Any) -> None:
         # Use upsert, search and compact callbacks
         self.findex_interface.set_upsert_callbacks(
             self.findex_backend.fetch_entry,
@@ -256,18 +386,14 @@ class TestFindex(unittest.TestCase):
         )
         self.findex_interface.set_compact_callbacks(
             self.findex_backend.fetch_entry,
-            self.findex_backend.fetch_chain,
+            fetch_chain,
             self.findex_backend.update_lines,
             self.findex_backend.list_removed_locations,
             self.findex_backend.fetch_all_entry_table_uids,
+            **compact_options,
         )
 
-        indexed_values_and_keywords = {
-            IndexedValue.from_location(k): v for k, v in self.db.items()
-        }
-        self.findex_interface.upsert_wrapper(
-            indexed_values_and_keywords, self.msk, self.label
-        )
+        self.findex_interface.upsert_wrapper_locations(self.db, self.msk, self.label)
 
         new_label = Label.random()
         res = self.findex_interface.search_wrapper(['Sheperd'], self.msk, new_label)
@@ -292,6 +418,26 @@ class TestFindex(unittest.TestCase):
         assert 'Martial' not in res
         assert 'Wilkins' not in res
 
+    def test_compact(self) -> None:
+        self.compact_and_check(self.findex_backend.fetch_chain)
+
+    def test_compact_with_executor(self) -> None:
+        executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        self.addCleanup(executor.shutdown)
+
+        # Record the batches fetched by the executor threads
+        executor_batches: List[List[bytes]] = []
+
+        def fetch_chain(uids: List[bytes]) -> Dict[bytes, bytes]:
+            if threading.current_thread() is not threading.main_thread():
+                executor_batches.append(uids)
+            return self.findex_backend.fetch_chain(uids)
+
+        # Fetch each chain in its own batch during compact
+        self.compact_and_check(fetch_chain, executor=executor, batch_size=1)
+        self.assertGreater(len(executor_batches), 1)
+        self.assertTrue(all(len(batch) == 1 for batch in executor_batches))
+
 
 if __name__ == '__main__':
     unittest.main()
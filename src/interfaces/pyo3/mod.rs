@@ -4,7 +4,7 @@ mod py_api;
 mod py_structs;
 
 use py_api::InternalFindex;
-use py_structs::{IndexedValue, Label, MasterKey};
+use py_structs::{IndexedValue, Label, MasterKey, MaxResults, StopOnKeyword};
 use pyo3::prelude::*;
 
 #[pymodule]
@@ -13,5 +13,7 @@ fn cosmian_findex(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_class::<Label>()?;
     m.add_class::<MasterKey>()?;
     m.add_class::<IndexedValue>()?;
+    m.add_class::<StopOnKeyword>()?;
+    m.add_class::<MaxResults>()?;
     Ok(())
 }
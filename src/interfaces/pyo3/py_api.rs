@@ -1,7 +1,11 @@
-use std::collections::{HashMap, HashSet};
+use std::{
+    cell::Cell,
+    collections::{HashMap, HashSet},
+};
 
 use futures::executor::block_on;
 use pyo3::{
+    exceptions::PyValueError,
     prelude::*,
     types::{PyBytes, PyDict},
 };
@@ -18,11 +22,27 @@ use crate::{
             MASTER_KEY_LENGTH, TABLE_WIDTH, UID_LENGTH,
         },
         pyo3::py_structs::{
-            IndexedValue as IndexedValuePy, Label as LabelPy, MasterKey as MasterKeyPy,
+            IndexedValue as IndexedValuePy, KeywordInput, Label as LabelPy,
+            MasterKey as MasterKeyPy, MaxResults, StopOnKeyword,
         },
     },
 };
 
+/// Default number of UIDs given to each `fetch_chain` call dispatched to the
+/// executor set by `set_compact_callbacks`.
+const DEFAULT_COMPACT_BATCH_SIZE: usize = 1000;
+
+/// Progress callback called during a search.
+enum ProgressCallback {
+    /// Python function called with the partial results.
+    Python(PyObject),
+    /// Stops the search once the given keyword is reached.
+    StopOnKeyword(Keyword),
+    /// Stops the search once at least the given number of locations have
+    /// been found.
+    MaxResults(usize),
+}
+
 #[pyclass(subclass)]
 pub struct InternalFindex {
     fetch_entry: PyObject,
@@ -31,8 +51,14 @@ pub struct InternalFindex {
     insert_chain: PyObject,
     update_lines: PyObject,
     list_removed_locations: PyObject,
-    progress_callback: PyObject,
+    progress_callback: ProgressCallback,
     fetch_all_entry_table_uids: PyObject,
+    compact_executor: Option<PyObject>,
+    compact_batch_size: usize,
+    is_compacting: bool,
+    /// Number of locations found so far by the current search, used by the
+    /// `MaxResults` predicate.
+    n_found_locations: Cell<usize>,
 }
 
 impl FindexCallbacks<UID_LENGTH> for InternalFindex {
@@ -40,6 +66,20 @@ impl FindexCallbacks<UID_LENGTH> for InternalFindex {
         &self,
         results: &HashMap<Keyword, HashSet<IndexedValueRust>>,
     ) -> Result<bool, FindexErr> {
+        // Predicates are evaluated in Rust, without converting the results nor
+        // acquiring the GIL.
+        let progress_callback = match &self.progress_callback {
+            ProgressCallback::Python(progress_callback) => progress_callback,
+            ProgressCallback::StopOnKeyword(keyword) => return Ok(!results.contains_key(keyword)),
+            ProgressCallback::MaxResults(max_results) => {
+                // Partial results only contain the locations of the current recursion level.
+                let n_locations = self.n_found_locations.get()
+                    + results.values().map(HashSet::len).sum::<usize>();
+                self.n_found_locations.set(n_locations);
+                return Ok(n_locations < *max_results);
+            }
+        };
+
         let py_results = results
             .iter()
             .map(|(keyword, indexed_values)| {
@@ -54,8 +94,7 @@ impl FindexCallbacks<UID_LENGTH> for InternalFindex {
             .collect::<HashMap<_, _>>();
 
         Python::with_gil(|py| {
-            let ret = self
-                .progress_callback
+            let ret = progress_callback
                 .call1(py, (py_results,))
                 .map_err(|e| FindexErr::CallBack(format!("{e} (progress_callback)")))?;
 
@@ -122,21 +161,52 @@ impl FindexCallbacks<UID_LENGTH> for InternalFindex {
                 .map(|uid| PyBytes::new(py, uid))
                 .collect::<Vec<_>>();
 
-            let result = self
-                .fetch_chain
-                .call1(py, (py_chain_uids,))
-                .map_err(|e| FindexErr::CallBack(format!("{e} (fetch_chain)")))?;
-
-            let py_result_table: HashMap<[u8; UID_LENGTH], Vec<u8>> = result
-                .extract(py)
-                .map_err(|e| FindexErr::ConversionError(format!("{e} (fetch_chain)")))?;
-
-            // Convert python result (HashMap<[u8; UID_LENGTH], Vec<u8>>) to
+            // The executor is only used by compact, and only if there is more than
+            // one batch to fetch.
+            let executor = self
+                .compact_executor
+                .as_ref()
+                .filter(|_| self.is_compacting && py_chain_uids.len() > self.compact_batch_size);
+
+            let results = match executor {
+                None => {
+                    let result = self
+                        .fetch_chain
+                        .call1(py, (py_chain_uids,))
+                        .map_err(|e| FindexErr::CallBack(format!("{e} (fetch_chain)")))?;
+                    vec![result]
+                }
+                Some(executor) => {
+                    // Dispatch batches of UIDs to the executor to fetch them concurrently.
+                    let batches = py_chain_uids
+                        .chunks(self.compact_batch_size)
+                        .map(<[_]>::to_vec)
+                        .collect::<Vec<_>>();
+                    let results = executor
+                        .call_method1(py, "map", (self.fetch_chain.clone_ref(py), batches))
+                        .map_err(|e| FindexErr::CallBack(format!("{e} (fetch_chain)")))?;
+                    results
+                        .as_ref(py)
+                        .iter()
+                        .and_then(|results| {
+                            results
+                                .map(|result| result.map(PyObject::from))
+                                .collect::<PyResult<Vec<_>>>()
+                        })
+                        .map_err(|e| FindexErr::CallBack(format!("{e} (fetch_chain)")))?
+                }
+            };
+
+            // Convert python results (HashMap<[u8; UID_LENGTH], Vec<u8>>) to
             // EncryptedTable<UID_LENGTH>
-            let chain_table_items = py_result_table
-                .into_iter()
-                .map(|(k, v)| (Uid::from(k), v))
-                .collect::<HashMap<_, _>>();
+            let mut chain_table_items = HashMap::with_capacity(chain_uids.len());
+            for result in results {
+                let py_result_table: HashMap<[u8; UID_LENGTH], Vec<u8>> = result
+                    .extract(py)
+                    .map_err(|e| FindexErr::ConversionError(format!("{e} (fetch_chain)")))?;
+                chain_table_items
+                    .extend(py_result_table.into_iter().map(|(k, v)| (Uid::from(k), v)));
+            }
             Ok(chain_table_items.into())
         })
     }
@@ -328,8 +398,12 @@ impl InternalFindex {
             insert_chain: default_callback.clone(),
             update_lines: default_callback.clone(),
             list_removed_locations: default_callback.clone(),
-            progress_callback: default_callback.clone(),
+            progress_callback: ProgressCallback::Python(default_callback.clone()),
             fetch_all_entry_table_uids: default_callback,
+            compact_executor: None,
+            compact_batch_size: DEFAULT_COMPACT_BATCH_SIZE,
+            is_compacting: false,
+            n_found_locations: Cell::new(0),
         })
     }
 
@@ -348,18 +422,36 @@ impl InternalFindex {
     }
 
     /// Sets the required callbacks to implement [`FindexSearch`].
+    ///
+    /// The `progress_callback` can either be a Python function or one of the
+    /// `StopOnKeyword` and `MaxResults` predicates, which are evaluated
+    /// without calling Python.
     pub fn set_search_callbacks(
         &mut self,
+        py: Python,
         fetch_entry: PyObject,
         fetch_chain: PyObject,
         progress_callback: PyObject,
     ) {
         self.fetch_entry = fetch_entry;
         self.fetch_chain = fetch_chain;
-        self.progress_callback = progress_callback;
+        self.progress_callback = if let Ok(StopOnKeyword(keyword)) = progress_callback.extract(py) {
+            ProgressCallback::StopOnKeyword(keyword)
+        } else if let Ok(MaxResults(max_results)) = progress_callback.extract(py) {
+            ProgressCallback::MaxResults(max_results)
+        } else {
+            ProgressCallback::Python(progress_callback)
+        };
     }
 
     /// Sets the required callbacks to implement [`FindexCompact`].
+    ///
+    /// If an `executor` (e.g. a `concurrent.futures.ThreadPoolExecutor`) is
+    /// given, the Chain Table fetches performed by `compact_wrapper` are split
+    /// into batches of `batch_size` UIDs which are given to `fetch_chain`
+    /// concurrently using `executor.map`. This is useful when each call to the
+    /// database has a non-trivial latency.
+    #[args(executor = "None", batch_size = "1000")]
     pub fn set_compact_callbacks(
         &mut self,
         fetch_entry: PyObject,
@@ -367,12 +459,22 @@ impl InternalFindex {
         update_lines: PyObject,
         list_removed_locations: PyObject,
         fetch_all_entry_table_uids: PyObject,
-    ) {
+        executor: Option<PyObject>,
+        batch_size: usize,
+    ) -> PyResult<()> {
+        if batch_size == 0 {
+            return Err(PyValueError::new_err(
+                "the compact batch size should be greater than 0",
+            ));
+        }
         self.fetch_entry = fetch_entry;
         self.fetch_chain = fetch_chain;
         self.update_lines = update_lines;
         self.list_removed_locations = list_removed_locations;
         self.fetch_all_entry_table_uids = fetch_all_entry_table_uids;
+        self.compact_executor = executor;
+        self.compact_batch_size = batch_size;
+        Ok(())
     }
 
     /// Upserts the given relations between `IndexedValue` and `Keyword` into
@@ -382,26 +484,54 @@ impl InternalFindex {
     ///
     /// Parameters
     ///
-    /// - `indexed_values_and_strings`  : map of `IndexedValue` to keywords
+    /// - `indexed_values_and_keywords` : map of `IndexedValue` to keywords
+    ///   given as bytes or strings
     /// - `master_key`                  : Findex master key
     /// - `label`                       : label used to allow versioning
     pub fn upsert_wrapper(
         &mut self,
-        indexed_values_and_strings: HashMap<IndexedValuePy, Vec<&str>>,
+        indexed_values_and_keywords: HashMap<IndexedValuePy, Vec<KeywordInput>>,
         master_key: &MasterKeyPy,
         label: &LabelPy,
     ) -> PyResult<()> {
-        let mut indexed_values_and_keywords =
-            HashMap::with_capacity(indexed_values_and_strings.len());
-        for (indexed_value, strings) in indexed_values_and_strings {
-            let mut keywords = HashSet::with_capacity(strings.len());
-            for string in strings {
-                keywords.insert(Keyword::from(string));
-            }
-            indexed_values_and_keywords.insert(indexed_value.0, keywords);
-        }
-        let future = self.upsert(indexed_values_and_keywords, &master_key.0, &label.0);
-        block_on(future).map_err(PyErr::from)
+        self.upsert_keywords(
+            indexed_values_and_keywords
+                .into_iter()
+                .map(|(indexed_value, keywords)| (indexed_value.0, keywords)),
+            master_key,
+            label,
+        )
+    }
+
+    /// Upserts the given relations between `Location` and `Keyword` into
+    /// Findex tables. This is equivalent to `upsert_wrapper` when all the
+    /// indexed values are locations but avoids creating one `IndexedValue`
+    /// Python object per location.
+    ///
+    /// Parameters
+    ///
+    /// - `locations_and_keywords`  : map of location bytes to keywords given as
+    ///   bytes or strings
+    /// - `master_key`              : Findex master key
+    /// - `label`                   : label used to allow versioning
+    pub fn upsert_wrapper_locations(
+        &mut self,
+        locations_and_keywords: HashMap<&[u8], Vec<KeywordInput>>,
+        master_key: &MasterKeyPy,
+        label: &LabelPy,
+    ) -> PyResult<()> {
+        self.upsert_keywords(
+            locations_and_keywords
+                .into_iter()
+                .map(|(location, keywords)| {
+                    (
+                        IndexedValueRust::Location(Location::from(location)),
+                        keywords,
+                    )
+                }),
+            master_key,
+            label,
+        )
     }
 
     /// Recursively search Findex graphs for `Location` corresponding to the
@@ -428,19 +558,13 @@ impl InternalFindex {
         max_result_per_keyword: usize,
         max_depth: usize,
     ) -> PyResult<HashMap<String, Vec<IndexedValuePy>>> {
-        let keywords_set: HashSet<Keyword> = keywords
-            .iter()
-            .map(|keyword| Keyword::from(*keyword))
-            .collect();
-
-        let results = block_on(self.search(
-            &keywords_set,
-            &master_key.0,
-            &label.0,
+        let results = self.search_strings(
+            keywords,
+            master_key,
+            label,
             max_result_per_keyword,
             max_depth,
-            0,
-        ))?;
+        )?;
 
         results
             .into_iter()
@@ -456,6 +580,73 @@ impl InternalFindex {
             .map_err(PyErr::from)
     }
 
+    /// Recursively search Findex graphs for `Location` corresponding to the
+    /// given `Keyword`. Contrary to `search_wrapper`, the locations found for
+    /// each keyword are returned in a single buffer instead of one Python
+    /// object per location.
+    ///
+    /// For each keyword, the returned `offsets` are native-endian `u32`
+    /// delimiting the locations inside `payload`: the `i`-th location is
+    /// `payload[offsets[i]..offsets[i + 1]]`. Both buffers are meant to be read
+    /// without copy through memory views:
+    ///
+    /// ```python
+    /// offsets_view = memoryview(offsets).cast('I')
+    /// payload_view = memoryview(payload)
+    /// location_i = payload_view[offsets_view[i] : offsets_view[i + 1]]
+    /// ```
+    ///
+    /// Slicing `payload` directly would allocate a new `bytes` per location.
+    ///
+    /// *Note*: only `Location`s are returned, `NextKeyword`s found when
+    /// reaching `max_depth` are ignored.
+    ///
+    /// Parameters
+    ///
+    /// - `keywords`                : keywords to search using Findex
+    /// - `master_key`              : user secret key
+    /// - `label`                   : public label used in keyword hashing
+    /// - `max_results_per_keyword` : maximum number of results to fetch per
+    ///   keyword
+    /// - `max_depth`               : maximum recursion level allowed
+    ///
+    /// Returns: Dict[str, Tuple[bytes, bytes]]
+    // use `u32::MAX` for `max_result_per_keyword`
+    #[args(max_result_per_keyword = "4294967295")]
+    #[args(max_depth = "100")]
+    pub fn search_wrapper_bulk(
+        &mut self,
+        py: Python,
+        keywords: Vec<&str>,
+        master_key: &MasterKeyPy,
+        label: &LabelPy,
+        max_result_per_keyword: usize,
+        max_depth: usize,
+    ) -> PyResult<HashMap<String, (Py<PyBytes>, Py<PyBytes>)>> {
+        let results = self.search_strings(
+            keywords,
+            master_key,
+            label,
+            max_result_per_keyword,
+            max_depth,
+        )?;
+
+        results
+            .into_iter()
+            .map(|(keyword, indexed_values)| {
+                let (offsets, payload) = locations_to_buffers(&indexed_values)?;
+                Ok((
+                    keyword.try_into_string()?,
+                    (
+                        PyBytes::new(py, &offsets).into(),
+                        PyBytes::new(py, &payload).into(),
+                    ),
+                ))
+            })
+            .collect::<Result<_, FindexErr>>()
+            .map_err(PyErr::from)
+    }
+
     /// Replace all the previous Index Entry Table UIDs and
     /// values with new ones (UID will be re-hash with the new label and
     /// values will be re-encrypted with a new nonce).
@@ -481,12 +672,83 @@ impl InternalFindex {
         new_master_key: &MasterKeyPy,
         new_label: &LabelPy,
     ) -> PyResult<()> {
-        block_on(self.compact(
+        self.is_compacting = true;
+        let res = block_on(self.compact(
             num_reindexing_before_full_set,
             &master_key.0,
             &new_master_key.0,
             &new_label.0,
+        ));
+        self.is_compacting = false;
+        res.map_err(PyErr::from)
+    }
+}
+
+impl InternalFindex {
+    /// Upserts the given `IndexedValue`s for the given keywords. Shared by
+    /// the upsert wrappers.
+    fn upsert_keywords<'a>(
+        &mut self,
+        indexed_values_and_keywords: impl IntoIterator<Item = (IndexedValueRust, Vec<KeywordInput<'a>>)>,
+        master_key: &MasterKeyPy,
+        label: &LabelPy,
+    ) -> PyResult<()> {
+        let indexed_values_and_keywords = indexed_values_and_keywords
+            .into_iter()
+            .map(|(indexed_value, keywords)| {
+                (
+                    indexed_value,
+                    keywords
+                        .into_iter()
+                        .map(Keyword::from)
+                        .collect::<HashSet<_>>(),
+                )
+            })
+            .collect::<HashMap<_, _>>();
+        let future = self.upsert(indexed_values_and_keywords, &master_key.0, &label.0);
+        block_on(future).map_err(PyErr::from)
+    }
+
+    /// Recursively searches the given keywords. Shared by the search
+    /// wrappers.
+    fn search_strings(
+        &mut self,
+        keywords: Vec<&str>,
+        master_key: &MasterKeyPy,
+        label: &LabelPy,
+        max_result_per_keyword: usize,
+        max_depth: usize,
+    ) -> PyResult<HashMap<Keyword, HashSet<IndexedValueRust>>> {
+        let keywords_set: HashSet<Keyword> = keywords.into_iter().map(Keyword::from).collect();
+
+        self.n_found_locations.set(0);
+        block_on(self.search(
+            &keywords_set,
+            &master_key.0,
+            &label.0,
+            max_result_per_keyword,
+            max_depth,
+            0,
         ))
         .map_err(PyErr::from)
     }
 }
+
+/// Concatenates the `Location`s of the given `IndexedValue`s into a single
+/// payload. Returns the native-endian `u32` offsets delimiting each location
+/// in the payload (starting with `0`) along with the payload.
+fn locations_to_buffers(
+    indexed_values: &HashSet<IndexedValueRust>,
+) -> Result<(Vec<u8>, Vec<u8>), FindexErr> {
+    let mut offsets = Vec::with_capacity((indexed_values.len() + 1) * 4);
+    let mut payload = Vec::new();
+    offsets.extend_from_slice(&0_u32.to_ne_bytes());
+    for location in indexed_values
+        .iter()
+        .filter_map(IndexedValueRust::get_location)
+    {
+        payload.extend_from_slice(location);
+        offsets.extend_from_slice(&u32::try_from(payload.len())?.to_ne_bytes());
+    }
+    Ok((offsets, payload))
+}
@@ -182,3 +182,67 @@ impl MasterKey {
         PyBytes::new(py, &self.0).into()
     }
 }
+
+/// Progress predicate stopping a search once the given keyword is reached
+/// by the recursion. It is evaluated by Findex without calling Python.
+#[pyclass]
+#[derive(Clone)]
+pub struct StopOnKeyword(pub(super) Keyword);
+
+#[pymethods]
+impl StopOnKeyword {
+    /// Create a predicate stopping the search on the given keyword.
+    ///
+    /// Args:
+    ///     keyword (Union[str, bytes])
+    ///
+    /// Returns:
+    ///     StopOnKeyword
+    #[new]
+    pub fn new(keyword: KeywordInput) -> Self {
+        Self(Keyword::from(keyword))
+    }
+}
+
+/// Progress predicate stopping a search once at least the given number of
+/// locations have been found, counting all the recursion levels explored so
+/// far. Since all the locations of the last explored level are returned, the
+/// search may return more locations than this number. It is evaluated by
+/// Findex without calling Python.
+#[pyclass]
+#[derive(Clone)]
+pub struct MaxResults(pub(super) usize);
+
+#[pymethods]
+impl MaxResults {
+    /// Create a predicate stopping the search after `max_results` locations.
+    ///
+    /// Args:
+    ///     max_results (int)
+    ///
+    /// Returns:
+    ///     MaxResults
+    #[new]
+    pub fn new(max_results: usize) -> Self {
+        Self(max_results)
+    }
+}
+
+/// Keyword given to an upsert, either as bytes or as a string. Bytes are used
+/// as is, avoiding the UTF-8 encoding of strings.
+#[derive(FromPyObject)]
+pub enum KeywordInput<'a> {
+    #[pyo3(transparent)]
+    Bytes(&'a [u8]),
+    #[pyo3(transparent)]
+    String(&'a str),
+}
+
+impl From<KeywordInput<'_>> for Keyword {
+    fn from(keyword: KeywordInput<'_>) -> Self {
+        match keyword {
+            KeywordInput::Bytes(bytes) => Self::from(bytes),
+            KeywordInput::String(string) => Self::from(string),
+        }
+    }
+}